@@ -1,5 +1,8 @@
 import io
 import os
+import queue
+import select
+import multiprocessing
 import concurrent.futures
 import traceback
 import time
@@ -22,8 +25,7 @@ HEADERS = [
 
 
 class _Handle:
-    def __init__(self, url, config):
-        self.__url = url
+    def __init__(self, config):
         self.__config = config
 
         self.__nsserver = config.nsserver
@@ -38,21 +40,20 @@ class _Handle:
 
         # local vars
         self.handle = pycurl.Curl()
-        self.__buf = None
+        self.__url = None
+        self.__buf = io.BytesIO()
         self.__bufsize_exceeded = None
-        self.__header_buf = None
+        self.__header_buf = io.BytesIO()
         self.__headersize_exceeded = None
 
-        # call reset to reinitialize curl handle and buffer
-        self.reset()
+        self.__setup()
 
-    def reset(self):
-        self.handle.reset()
+    def __setup(self):
+        # These options are the same for every url, libcurl keeps them between transfers so we only set them once
 
         # NOTE: Needs c-ares
         if self.__enabled_ares:
             self.handle.setopt(pycurl.DNS_SERVERS, self.__nsserver)
-        self.handle.setopt(pycurl.URL, self.__url)
         if self.__useragent is not None:
             self.handle.setopt(pycurl.USERAGENT, self.__useragent)
         self.handle.setopt(pycurl.HTTPHEADER, HEADERS)
@@ -70,11 +71,21 @@ class _Handle:
         self.handle.setopt(pycurl.DNS_CACHE_TIMEOUT, 0)
         self.handle.setopt(pycurl.BUFFERSIZE, self.__contentbuffersize)
 
-        self.__buf = io.BytesIO()
+    def reset(self, url):
+        # Only the per-url state is reset here, this is what makes handles reusable
+        self.handle.setopt(pycurl.URL, url)
+        self.__url = url
+
+        self.__buf.seek(0)
+        self.__buf.truncate()
         self.__bufsize_exceeded = False
-        self.__header_buf = io.BytesIO()
+        self.__header_buf.seek(0)
+        self.__header_buf.truncate()
         self.__headersize_exceeded = False
 
+    def close(self):
+        self.handle.close()
+
     def __do_write(self, buf, size_exceeded, maxsize, newdata):
         # Returns size_exceeded, always!
         if size_exceeded is True:
@@ -102,13 +113,79 @@ class _Handle:
         return self.__url, buf, headers
 
 
+class _AdaptiveController:
+    # AIMD controller for the number of in-flight handles and the read interval of the poll loop.
+    #   - timeouts above the allowed rate, a saturated loop or falling throughput after a raise: multiplicative decrease
+    #   - otherwise, if we actually use all handles: additive increase
+    DECREASE_FACTOR = 0.75
+    INCREASE_STEP = 0.05        # grow by 5% of the allowed range per step
+    THROUGHPUT_DROP = 0.9       # throughput falling below 90% of the previous period counts as congestion
+    MAX_LOAD = 0.9              # fraction of the loop spent outside of sleep/poll
+    MIN_READ_INTERVAL = 0.001
+    MAX_READ_INTERVAL = 0.1
+
+    def __init__(self, config):
+        self.maxhandles = config.pycurl_maxhandles
+        self.read_interval = config.pycurl_read_interval_ms
+        self.last_decision = "hold"
+
+        self.__min_handles = config.pycurl_adaptive_min_handles
+        self.__max_handles = config.pycurl_adaptive_max_handles
+        self.__max_timeout_rate = config.pycurl_adaptive_max_timeout_rate
+        self.__step = max(1, int((self.__max_handles - self.__min_handles) * self.INCREASE_STEP))
+
+        self.__last_throughput = None
+        self.__last_increased = False
+
+        if not self.__min_handles <= self.maxhandles <= self.__max_handles:
+            raise ValueError("maxhandles must be between the adaptive min and max handles")
+
+    def update(self, throughput, timeout_rate, load, inprogress):
+        if timeout_rate > self.__max_timeout_rate:
+            self.__decrease("timeouts %.1f%%" % (timeout_rate * 100))
+        elif load > self.MAX_LOAD:
+            self.__decrease("load %.0f%%" % (load * 100))
+        elif self.__last_increased and self.__last_throughput is not None\
+        and throughput < self.__last_throughput * self.THROUGHPUT_DROP:
+            self.__decrease("throughput %d/s" % throughput)
+        elif inprogress >= self.maxhandles * .8 and self.maxhandles < self.__max_handles:
+            self.maxhandles = min(self.__max_handles, self.maxhandles + self.__step)
+            self.__last_increased = True
+            self.last_decision = "+handles"
+        else:
+            self.__last_increased = False
+            self.last_decision = "hold"
+
+        # the read interval follows the load: back off when the loop is busy, poll sooner when it's mostly idle
+        if load > self.MAX_LOAD:
+            self.read_interval = min(self.MAX_READ_INTERVAL, self.read_interval * 2)
+        elif load < self.MAX_LOAD / 3:
+            self.read_interval = max(self.MIN_READ_INTERVAL, self.read_interval - self.MIN_READ_INTERVAL)
+
+        self.__last_throughput = throughput
+
+    def __decrease(self, reason):
+        self.maxhandles = max(self.__min_handles, int(self.maxhandles * self.DECREASE_FACTOR))
+        self.__last_increased = False
+        self.last_decision = "-handles (%s)" % reason
+
+
 class FastFetch:
-    def __init__(self, name, urls_to_crawl, config):
+    # url_source and result_sink are used by the persistent workers:
+    #   url_source(block) returns a list of new urls, [] if there are none right now, or None if there won't be more
+    #   result_sink(results) receives the results in chunks instead of collecting them in self.results
+    def __init__(self, name, urls_to_crawl, config, url_source=None, result_sink=None):
         self.name = name
         self.urls_to_crawl = urls_to_crawl
+        self.__url_source = url_source
+        self.__source_exhausted = url_source is None
+        self.__result_sink = result_sink
+        self.__result_chunksize = config.pycurl_result_chunksize
+        self.__last_flush = dt.now()
 
         self.__config = config
 
+        self.__loop = config.pycurl_loop
         self.__read_interval = config.pycurl_read_interval_ms
         self.__print_enabled = config.pycurl_workers_print_log
         self.__maxhandles = config.pycurl_maxhandles
@@ -119,18 +196,33 @@ class FastFetch:
 
         self.success = 0
         self.failure = 0
+        self.timeouts = 0
         self.results = []
         self.skipped = 0
 
+        self.__controller = _AdaptiveController(config) if config.pycurl_adaptive else None
+        self.__idle = 0.0
+        self.__last_adapt = dt.now()
+        self.__last_adapt_processed = 0
+        self.__last_adapt_timeouts = 0
+
         if 1000000 < self.__maxhandles < 1:
             raise ValueError("maxhandles is outside the range 0..1000000")
 
         self.__check_for_features()
 
+        # event loop state, only used by the epoll loop
+        self.__epoll = None
+        self.__sockets = set()
+        self.__timer_deadline = None
+
         self.multi_handle = self.__get_multi_handle()
 
         self.handles_inprogress = {}
         self.handles_free = []
+        self.__handle_pool_size = config.pycurl_handle_pool_size
+        self.pool_hits = 0
+        self.pool_misses = 0
         self.last_status = dt.now()
         self.start_time = dt.now()
         self.num_processed = 0
@@ -147,6 +239,8 @@ class FastFetch:
                 print("! WARNING c-ares support is not built in! !")
                 print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
                 raise RuntimeError("Version [%s] has no async DNS enabled" % versiondata)
+        if self.__loop == "epoll" and not hasattr(select, "epoll"):
+            raise RuntimeError("The epoll loop needs select.epoll, which is not available on this platform")
 
     def __get_multi_handle(self):
         handle = pycurl.CurlMulti()
@@ -157,29 +251,89 @@ class FastFetch:
         # #0  Curl_removeHandleFromPipeline (handle=handle@entry=0x3c4f730, pipeline=0x0) at url.c:2866
         handle.setopt(pycurl.M_PIPELINING, 0)
 
+        if self.__loop == "epoll":
+            # NOTE: the callbacks have to be in place before the first handle is added
+            self.__epoll = select.epoll()
+            handle.setopt(pycurl.M_SOCKETFUNCTION, self.__on_socket)
+            handle.setopt(pycurl.M_TIMERFUNCTION, self.__on_timer)
+
         return handle
 
+    def __on_socket(self, what, sock, multi, socketp):
+        # called by libcurl whenever it wants us to start/stop watching a socket
+        if what == pycurl.POLL_REMOVE:
+            if sock in self.__sockets:
+                self.__sockets.remove(sock)
+                try:
+                    self.__epoll.unregister(sock)
+                except OSError:
+                    # the socket might be closed already, epoll forgets about those by itself
+                    pass
+            return
+
+        mask = 0
+        if what & pycurl.POLL_IN:
+            mask |= select.EPOLLIN
+        if what & pycurl.POLL_OUT:
+            mask |= select.EPOLLOUT
+
+        if sock in self.__sockets:
+            self.__epoll.modify(sock, mask)
+        else:
+            self.__epoll.register(sock, mask)
+            self.__sockets.add(sock)
+
+    def __on_timer(self, timeout_ms):
+        # called by libcurl to tell us when it wants to be woken up next, -1 means never
+        if timeout_ms < 0:
+            self.__timer_deadline = None
+        else:
+            self.__timer_deadline = time.monotonic() + timeout_ms / 1000
+
+    def __take_urls(self, n):
+        # we use the list instead of a queue, the url source only refills the list once it's used up
+        urls = self.urls_to_crawl[self.__url_idx:self.__url_idx+n]
+        self.__url_idx += len(urls)
+
+        while len(urls) < n and not self.__source_exhausted:
+            # only block for new urls if there is nothing else to do
+            chunk = self.__url_source(len(urls) == 0 and len(self.handles_inprogress) == 0)
+            if chunk is None:
+                self.__source_exhausted = True
+            elif len(chunk) == 0:
+                break
+            else:
+                more = chunk[:n - len(urls)]
+                self.urls_to_crawl = chunk
+                self.__url_idx = len(more)
+                urls += more
+
+        return urls
+
     def __fillhandles(self):
         free_handles = self.__maxhandles - len(self.handles_inprogress)
 
-        # we use the file instead of a queue
-        urls = self.urls_to_crawl[self.__url_idx:self.__url_idx+free_handles]
-        self.__url_idx += free_handles
+        urls = self.__take_urls(free_handles)
 
         if len(urls) == 0:
-            self.still_running = False
+            if self.__source_exhausted:
+                self.still_running = False
             return
 
         for url in urls:
             if len(self.handles_free) > 0:
                 # reuse handles if we have them
                 handle = self.handles_free.pop()
+                self.pool_hits += 1
             else:
-                try:
-                    handle = _Handle(url, self.__config)
-                except UnicodeEncodeError:
-                    # TODO: handle this before _Handle is called!
-                    raise
+                handle = _Handle(self.__config)
+                self.pool_misses += 1
+
+            try:
+                handle.reset(url)
+            except UnicodeEncodeError:
+                # TODO: handle this before _Handle.reset is called!
+                raise
 
             self.multi_handle.add_handle(handle.handle)
             self.handles_inprogress[handle.handle] = handle
@@ -188,13 +342,38 @@ class FastFetch:
         now = dt.now()
         if (dt.now() - self.last_status).total_seconds() > 1:
             if self.__print_enabled and self.num_processed > 0:
-                print("%s STATUS handles: %d, processed: %d, requests: %d/s, avg r/s: %d/s, good: %d, bad: %d, success rate: %.2f%%, lag: %.2f" % (
+                pool_hit_rate = self.pool_hits / max(self.pool_hits + self.pool_misses, 1) * 100
+                extra_status = ", pool hit rate: %.2f%%" % pool_hit_rate
+                if self.__controller is not None:
+                    extra_status += ", maxhandles: %d, interval: %.1fms, adapt: %s" % (
+                        self.__maxhandles, self.__read_interval * 1000, self.__controller.last_decision)
+                print("%s STATUS handles: %d, processed: %d, requests: %d/s, avg r/s: %d/s, good: %d, bad: %d, success rate: %.2f%%, lag: %.2f%s" % (
                     self.name, len(self.handles_inprogress), self.num_processed, self.num_processed - self.last_num_processed,
                     self.num_processed / ((dt.now()-self.start_time).total_seconds()),
-                    self.success, self.failure, self.success / self.num_processed * 100, (now-self.last_status).total_seconds()))
+                    self.success, self.failure, self.success / self.num_processed * 100, (now-self.last_status).total_seconds(),
+                    extra_status))
             self.last_status = now
             self.last_num_processed = self.num_processed
 
+    def __adapt(self, now):
+        elapsed = (now - self.__last_adapt).total_seconds()
+        if self.__controller is None or elapsed < 1:
+            return
+
+        processed = self.num_processed - self.__last_adapt_processed
+        timeouts = self.timeouts - self.__last_adapt_timeouts
+        timeout_rate = timeouts / processed if processed > 0 else 0
+        load = 1 - min(self.__idle / elapsed, 1)
+
+        self.__controller.update(processed / elapsed, timeout_rate, load, len(self.handles_inprogress))
+        self.__maxhandles = self.__controller.maxhandles
+        self.__read_interval = self.__controller.read_interval
+
+        self.__idle = 0.0
+        self.__last_adapt = now
+        self.__last_adapt_processed = self.num_processed
+        self.__last_adapt_timeouts = self.timeouts
+
     def __process_headers(self, header_buf):
         headers = {}
         header_str = header_buf.decode("utf-8", errors="ignore")
@@ -219,6 +398,8 @@ class FastFetch:
             self.success += 1
         else:
             self.failure += 1
+            if errno == pycurl.E_OPERATION_TIMEDOUT:
+                self.timeouts += 1
             error = "({} - {})".format(errno, errmsg)
             # NOTE: ignore errmsg for now as it's harder to group
             # error = "({})".format(errno)
@@ -242,60 +423,129 @@ class FastFetch:
             "error": error
         }
 
-        # free up libcurl stuff
+        # give the handle back to the pool, or free up libcurl stuff if the pool is full
         self.multi_handle.remove_handle(c)
-        c.close()
         del self.handles_inprogress[c]
-
-        # free handle, or reset
-        #handle.reset()
-        #self.handles_free.append(handle)
-        del handle
+        if len(self.handles_free) < self.__handle_pool_size:
+            self.handles_free.append(handle)
+        else:
+            handle.close()
 
         self.results.append(result)
 
+    def __flush_results(self, now, force=False):
+        if self.__result_sink is None or len(self.results) == 0:
+            return
+
+        if force or len(self.results) >= self.__result_chunksize or (now - self.__last_flush).total_seconds() > 1:
+            self.__result_sink(self.results)
+            self.results = []
+            self.__last_flush = now
+
+    def __read_responses(self):
+        num_q, ok_list, err_list = self.multi_handle.info_read()
+        for c in ok_list:
+            self.__handle_response(c)
+        for c, errno, errmsg in err_list:
+            self.__handle_response(c, errno, errmsg)
+
+        self.num_processed = self.num_processed + len(ok_list) + len(err_list)
+        return num_q
+
+    def __maybe_fillhandles(self, now):
+        if len(self.handles_inprogress) < self.__maxhandles * .9\
+        and (now - self.lastfill).total_seconds() > self.__lastfill_waittime:
+            self.__fillhandles()
+            self.lastfill = now
+
+    def __run_poll(self):
+        last_read = dt.now()
+        while self.still_running or len(self.handles_inprogress) > 0:
+            now = dt.now()
+
+            delta = (dt.now() - last_read).total_seconds()
+            if delta > self.__read_interval:
+                while True:
+                    ret, num_handles = self.multi_handle.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                last_read = dt.now()
+            else:
+                # Get a fresh dt.now() as multi_handle.perform() might take a long time
+                newdelta = (dt.now() - last_read).total_seconds()
+                sleeptime = self.__read_interval-newdelta
+                if sleeptime > 0:
+                    time.sleep(sleeptime)
+                    self.__idle += sleeptime
+
+            self.__read_responses()
+
+            self.__print_status()
+            self.__adapt(now)
+            self.__flush_results(now)
+
+            self.__maybe_fillhandles(now)
+
+    def __poll_timeout(self):
+        # never sleep longer than the refill wait time, otherwise we would starve the multi handle of urls
+        timeout = max(self.__lastfill_waittime, 0.001) if self.still_running else 1.0
+        if self.__timer_deadline is not None:
+            timeout = min(timeout, max(self.__timer_deadline - time.monotonic(), 0))
+        return timeout
+
+    def __run_epoll(self):
+        # kick off the handles added by the first fill
+        self.multi_handle.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+        while self.still_running or len(self.handles_inprogress) > 0:
+            poll_start = time.monotonic()
+            events = self.__epoll.poll(self.__poll_timeout())
+            self.__idle += time.monotonic() - poll_start
+            for fd, event in events:
+                action = 0
+                if event & select.EPOLLIN:
+                    action |= pycurl.CSELECT_IN
+                if event & select.EPOLLOUT:
+                    action |= pycurl.CSELECT_OUT
+                if event & (select.EPOLLERR | select.EPOLLHUP):
+                    action |= pycurl.CSELECT_ERR
+                self.multi_handle.socket_action(fd, action)
+
+            if self.__timer_deadline is not None and self.__timer_deadline <= time.monotonic():
+                self.__timer_deadline = None
+                self.multi_handle.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+            while self.__read_responses() > 0:
+                pass
+
+            now = dt.now()
+            self.__print_status()
+            self.__adapt(now)
+            self.__flush_results(now)
+
+            self.__maybe_fillhandles(now)
+
     def run(self):
         self.__fillhandles()
 
         try:
-            last_read = dt.now()
-            while self.still_running or len(self.handles_inprogress) > 0:
-                now = dt.now()
-
-                delta = (dt.now() - last_read).total_seconds()
-                if delta > self.__read_interval:
-                    while True:
-                        ret, num_handles = self.multi_handle.perform()
-                        if ret != pycurl.E_CALL_MULTI_PERFORM:
-                            break
-                    last_read = dt.now()
-                else:
-                    # Get a fresh dt.now() as multi_handle.perform() might take a long time
-                    newdelta = (dt.now() - last_read).total_seconds()
-                    sleeptime = self.__read_interval-newdelta
-                    if sleeptime > 0:
-                        time.sleep(sleeptime)
-
-                num_q, ok_list, err_list = self.multi_handle.info_read()
-                for c in ok_list:
-                    self.__handle_response(c)
-                for c, errno, errmsg in err_list:
-                    self.__handle_response(c, errno, errmsg)
-
-                self.num_processed = self.num_processed + len(ok_list) + len(err_list)
-
-                self.__print_status()
-
-                if len(self.handles_inprogress) < self.__maxhandles * .9\
-                and (now - self.lastfill).total_seconds() > self.__lastfill_waittime:
-                    self.__fillhandles()
-                    self.lastfill = now
+            if self.__loop == "epoll":
+                self.__run_epoll()
+            else:
+                self.__run_poll()
         except Exception as exc:
             print("%s Exception received: %s" % (self.name, exc))
             print(traceback.format_exc())
             return MyCurlException("???")
         else:
+            self.__flush_results(dt.now(), force=True)
             return self.results
+        finally:
+            for handle in self.handles_free:
+                handle.close()
+            self.handles_free = []
+            if self.__epoll is not None:
+                self.__epoll.close()
 
 
 # IMPORTANT: This needs to be a separate function as otherwise ProcessPoolExecutor won't work
@@ -308,6 +558,28 @@ def fetcher_main(id, urls, config):
     return results
 
 
+# Long running worker, keeps its multi handle full with url chunks from work_queue until it receives None,
+# and streams the results back in chunks through result_queue
+def persistent_fetcher_main(id, work_queue, result_queue, config):
+    os.nice(19)
+
+    def url_source(block):
+        try:
+            return work_queue.get(block=block, timeout=1)
+        except queue.Empty:
+            return []
+
+    def result_sink(results):
+        result_queue.put(("results", id, results))
+
+    f = FastFetch(id, [], config, url_source=url_source, result_sink=result_sink)
+    ret = f.run()
+    if type(ret) is MyCurlException:
+        result_queue.put(("error", id, ret))
+    else:
+        result_queue.put(("done", id, None))
+
+
 class PycurlEngine:
     def __init__(self, config):
         self.__config = config
@@ -316,6 +588,7 @@ class PycurlEngine:
         self.__max_processes = config.workers
         self.__batchsize_per_process = config.batchsize
         self.__max_spawns_per_iteration = config.pycurl_max_spawns_per_iteration
+        self.__persistent_workers = config.pycurl_persistent_workers
 
         self.__worker_id = 0
 
@@ -328,8 +601,19 @@ class PycurlEngine:
             exhausted = True
         return exhausted, batch
 
-    def run_forever(self):
-        self.__stats.start_clock()
+    def __collect_results(self, results):
+        for result in results:
+            # record statistics
+            if result["error"] is None:
+                self.__stats.add_success()
+            else:
+                print("ERROR", result["error"])
+                errormsg = result["error"]
+                self.__stats.add_error(errormsg)
+            self.__stats.add_processed()
+            yield result
+
+    def __run_batches(self):
         urls_exhausted = False
         with concurrent.futures.ProcessPoolExecutor(max_workers=self.__max_processes) as executor:
             futures = set()
@@ -358,19 +642,73 @@ class PycurlEngine:
                     if type(results) is MyCurlException:
                         raise results
 
-                    for result in results:
-                        # record statistics
-                        if result["error"] is None:
-                            self.__stats.add_success()
-                        else:
-                            print("ERROR", result["error"])
-                            errormsg = result["error"]
-                            self.__stats.add_error(errormsg)
-                        self.__stats.add_processed()
-                        yield result
+                    yield from self.__collect_results(results)
 
                 futures = not_done
 
                 self.__stats.print_periodic(len(futures), interval=1)
 
+    def __run_persistent(self):
+        # NOTE: the work queue is bounded so that we never read much more of the url file than the workers can chew
+        work_queue = multiprocessing.Queue(maxsize=self.__max_processes * 2)
+        result_queue = multiprocessing.Queue()
+
+        workers = []
+        for i in range(self.__max_processes):
+            args = ["worker_%s" % i, work_queue, result_queue, self.__config]
+            p = multiprocessing.Process(target=persistent_fetcher_main, args=args)
+            p.start()
+            workers.append(p)
+
+        running = len(workers)
+        urls_exhausted, urls_to_crawl, stopped = False, [], False
+        while running > 0:
+            # keep the work queue full, so that the workers never drain their multi handles
+            while not urls_exhausted:
+                if len(urls_to_crawl) == 0:
+                    urls_exhausted, urls_to_crawl = self.__read_url_batch(self.__batchsize_per_process)
+                    if len(urls_to_crawl) == 0:
+                        break
+                try:
+                    work_queue.put_nowait(urls_to_crawl)
+                except queue.Full:
+                    break
+                urls_to_crawl = []
+
+            if urls_exhausted and not stopped:
+                # tell every worker to finish up
+                for _ in workers:
+                    work_queue.put(None)
+                stopped = True
+
+            messages = []
+            try:
+                messages.append(result_queue.get(timeout=1))
+                while True:
+                    messages.append(result_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for kind, name, payload in messages:
+                if kind == "results":
+                    yield from self.__collect_results(payload)
+                elif kind == "done":
+                    running -= 1
+                elif kind == "error":
+                    for p in workers:
+                        p.terminate()
+                    raise payload
+
+            self.__stats.print_periodic(running, interval=1)
+
+        for p in workers:
+            p.join()
+
+    def run_forever(self):
+        self.__stats.start_clock()
+        if self.__persistent_workers:
+            yield from self.__run_persistent()
+        else:
+            yield from self.__run_batches()
+
         self.__stats.print_final()
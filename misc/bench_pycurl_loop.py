@@ -0,0 +1,62 @@
+import sys
+import resource
+from datetime import datetime as dt
+
+from helpers.config import CrawlConfig
+from helpers.filereader import FileReader
+from engines.engine_pycurl import FastFetch
+
+# Usage: python3 -m misc.bench_pycurl_loop <urlfile> <numurls>
+#   Compares the poll and the epoll loop of FastFetch, best used against misc/runserver.py so that
+#   the network is not the bottleneck.
+
+MAXHANDLES = [50, 500, 5000]
+LOOPS = ["poll", "epoll"]
+
+
+def get_config(loop, maxhandles):
+    config = CrawlConfig()
+    config.nsserver = "127.0.0.1"
+    config.useragent = None
+    config.timeout = 5
+    config.connect_timeout = 3
+    config.pycurl_loop = loop
+    config.pycurl_read_interval_ms = 10 / 1000
+    config.pycurl_workers_print_log = False
+    config.pycurl_maxhandles = maxhandles
+    config.pycurl_lastfill_waittime = 0.1
+    config.pycurl_enabled_ares = False
+    config.pycurl_contentbuffersize = 4096
+    config.pycurl_headerbuffersize = 4096
+    config.pycurl_adaptive = False
+    config.pycurl_result_chunksize = 1000
+    config.pycurl_handle_pool_size = maxhandles
+    return config
+
+
+def bench(urls, loop, maxhandles):
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = dt.now()
+
+    f = FastFetch("bench", urls, get_config(loop, maxhandles))
+    results = f.run()
+
+    delta = (dt.now() - start).total_seconds()
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    errors = len([r for r in results if r["error"] is not None])
+
+    print("{:6s} maxhandles: {:5d}, requests: {}, took: {:.2f}s, req/s: {:.2f}, cpu: {:.2f}s, cpu/req: {:.1f}us, errors: {}".format(
+        loop, maxhandles, len(results), delta, len(results) / delta, cpu, cpu / len(results) * 1000000, errors))
+
+
+if __name__ == "__main__":
+    fname = sys.argv[1]
+    numurls = int(sys.argv[2])
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (1000000, 1000000))
+
+    urls = FileReader(fname).get_batch(numurls)
+    for maxhandles in MAXHANDLES:
+        for loop in LOOPS:
+            bench(urls, loop, maxhandles)
@@ -87,6 +87,8 @@ if __name__ == "__main__":
                         help="Maximum number of handles to open (pycurl engine only)")
     parser.add_argument("--pycurl-readinterval", type=float, default=10,
                         help="Number of milliseconds to sleep in poll() (pycurl engine only), default is 10")
+    parser.add_argument("--pycurl-loop", type=str, choices=["poll", "epoll"], default="poll",
+                        help="poll: call perform() every readinterval, epoll: event driven socket_action() loop")
     parser.add_argument("--pycurl-enabled-ares", type=bool, default=False,
                         help="Is libc-ares2 enabled? (Might need custom libcurl compilation)")
     parser.add_argument("--pycurl-print-errors", type=bool, default=False,
@@ -98,10 +100,24 @@ if __name__ == "__main__":
                         help="Buffer size to use for response body")
     parser.add_argument("--pycurl-maxheadersize", type=int, default=4096,
                         help="Buffer size to use for response headers")
+    parser.add_argument("--pycurl-handle-pool-size", type=int, default=1000,
+                        help="Keep at most this many finished curl handles per worker for reuse")
     parser.add_argument("--pycurl-lastfill_waittime", type=float, default=0.1,
                         help="Wait this much time before refilling done handles, float seconds")
     parser.add_argument("--pycurl-max-spawns-per-iteration", type=int, default=3,
                         help="Spawn this many processes at once")
+    parser.add_argument("--pycurl-persistent-workers", type=bool, default=False,
+                        help="Keep --workers long running processes fed from a queue, --batchsize urls per chunk")
+    parser.add_argument("--pycurl-result-chunksize", type=int, default=1000,
+                        help="Persistent workers send back results in chunks of this size (or at least every second)")
+    parser.add_argument("--pycurl-adaptive", type=bool, default=False,
+                        help="Adapt maxhandles and readinterval at runtime based on throughput, timeouts and load")
+    parser.add_argument("--pycurl-adaptive-min-handles", type=int, default=10,
+                        help="Never go below this many handles per worker in adaptive mode")
+    parser.add_argument("--pycurl-adaptive-max-handles", type=int, default=5000,
+                        help="Never go above this many handles per worker in adaptive mode")
+    parser.add_argument("--pycurl-adaptive-max-timeout-rate", type=float, default=0.1,
+                        help="Shrink the number of handles when more than this fraction of requests time out")
     args = parser.parse_args()
     # end
 
@@ -123,17 +139,27 @@ if __name__ == "__main__":
     config.pycurl_maxhandles = args.pycurl_maxhandles
     # read_interval:
     #   Very important, this is the time we wait between reads. Too small and you get cpu bound, too little
-    #   and buffer is not read often enough to maximize speed. This should be adaptable, based on current conditions,
-    #   but I'm lazy to write that code right now.
+    #   and buffer is not read often enough to maximize speed. With --pycurl-adaptive True this is only the starting
+    #   value, the workers adapt it (and maxhandles) based on current conditions.
     #   Values: 1-100 usually work best, if you don't want to test too much, just use 10
     config.pycurl_read_interval_ms = args.pycurl_readinterval / 1000
+    # loop:
+    #   "epoll" only wakes up when a socket is ready or libcurl's timer fires, so readinterval is ignored there
+    config.pycurl_loop = args.pycurl_loop
     config.pycurl_enabled_ares = args.pycurl_enabled_ares
     config.pycurl_print_errors = args.pycurl_print_errors
     config.pycurl_workers_print_log = args.pycurl_workers_print_log
     config.pycurl_contentbuffersize = args.pycurl_maxbodysize
     config.pycurl_headerbuffersize = args.pycurl_maxheadersize
     config.pycurl_lastfill_waittime = args.pycurl_lastfill_waittime
+    config.pycurl_handle_pool_size = args.pycurl_handle_pool_size
     config.pycurl_max_spawns_per_iteration = args.pycurl_max_spawns_per_iteration
+    config.pycurl_persistent_workers = args.pycurl_persistent_workers
+    config.pycurl_result_chunksize = args.pycurl_result_chunksize
+    config.pycurl_adaptive = args.pycurl_adaptive
+    config.pycurl_adaptive_min_handles = args.pycurl_adaptive_min_handles
+    config.pycurl_adaptive_max_handles = args.pycurl_adaptive_max_handles
+    config.pycurl_adaptive_max_timeout_rate = args.pycurl_adaptive_max_timeout_rate
     ### end
 
     # set limits